@@ -1,11 +1,69 @@
 # ai_fraud_ml.py
+import os
 import re
+import numpy as np
 from joblib import load
-from functools import lru_cache
+from sklearn.utils import murmurhash3_32
+
+try:  # optional: JIT kernel for the batched top-token explain
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+COEF_PATH = "coef.npy"
+INTERCEPT_PATH = "intercept.npy"
+
+class _LinearScorer:
+    """Binary logistic scorer over mmap'd coef_/intercept_, so LogisticRegression isn't unpickled."""
+    def __init__(self, coef, intercept):
+        self.coef_, self.intercept_ = coef, intercept
+
+    def predict_proba(self, X):
+        p = 1.0 / (1.0 + np.exp(-(X @ self.coef_.T + self.intercept_)))
+        return np.hstack([1.0 - p, p])
+
+_MODEL = None
 
-@lru_cache(maxsize=1)
 def _load():
-    return load("fraud_model.joblib"), load("vectorizer.joblib")
+    global _MODEL
+    if _MODEL is None:
+        vec = load("vectorizer.joblib")
+        if os.path.exists(COEF_PATH) and os.path.exists(INTERCEPT_PATH):
+            # Pages are shared between processes through the OS page cache
+            clf = _LinearScorer(np.load(COEF_PATH, mmap_mode="r"), np.load(INTERCEPT_PATH, mmap_mode="r"))
+        else:
+            clf = load("fraud_model.joblib", mmap_mode="r")
+        _MODEL = (clf, vec)
+    return _MODEL
+
+QUANT_PATH = "fraud_model_q.joblib"
+
+def _load_quantized():
+    """int8 weights written by train_model.py -> (int32 coef, scale, intercept), or None."""
+    try:
+        q = load(QUANT_PATH)
+    except Exception:
+        return None
+    return q["coef_q"].astype(np.int32), float(q["scale"]), float(q["intercept"])
+
+# Pinned model state; the joblib files may be missing at import, so retry on first use
+CLF = VEC = FEATS = WEIGHTS = QUANT = None
+
+def _ensure_loaded():
+    global CLF, VEC, FEATS, WEIGHTS, QUANT
+    if CLF is None:
+        CLF, VEC = _load()
+        QUANT = _load_quantized()
+        WEIGHTS = CLF.coef_[0]
+        try:
+            FEATS = VEC.get_feature_names_out()
+        except Exception:
+            FEATS = None  # HashingVectorizer: names are recovered lazily per email
+
+try:
+    _ensure_loaded()
+except Exception:
+    pass
 
 def _amt_token(v):
     try:
@@ -16,6 +74,8 @@ def _amt_token(v):
     except Exception:
         return "AMOUNT_BIN:UNK"
 
+_WS = re.compile(r"\s+")
+
 def _combine(subject, body, from_domain, reply_domain, attachment_types, amount):
     txt = "\n".join([
         subject or "", body or "",
@@ -24,23 +84,112 @@ def _combine(subject, body, from_domain, reply_domain, attachment_types, amount)
         f"ATTACH:{(attachment_types or '').lower()}",
         _amt_token(amount)
     ])
-    return re.sub(r"\s+"," ", txt).strip()
+    return _WS.sub(" ", txt).strip()
 
-def predict_email_risk(subject, body, from_domain, reply_domain, attachment_types, amount):
-    clf, vec = _load()
-    X = vec.transform([_combine(subject, body, from_domain, reply_domain, attachment_types, amount)])
-    proba = float(clf.predict_proba(X)[0,1])
-    risk_score = int(round(proba*100))
+BATCH_SIZE = 256
 
-    # quick explain: top positive-weight tokens present
-    try:
-        feats = vec.get_feature_names_out()
-        weights = clf.coef_[0]
-        idx = X.nonzero()[1]
-        toks = [(feats[i], weights[i]) for i in idx]
-        toks.sort(key=lambda x: x[1], reverse=True)
-        top_tokens = [t for t,w in toks[:5] if w>0][:5]
-    except Exception:
-        top_tokens = []
+def _top_indices(X, r, weights, k=5):
+    """Feature indices of the top-k positive-weight tokens present in row r of a CSR matrix.
+
+    Ties keep CSR order, matching a stable sort over all the row's tokens.
+    """
+    idx = X.indices[X.indptr[r]:X.indptr[r+1]]
+    w = weights[idx]
+    keep = w > 0
+    pos, wp = idx[keep], w[keep]
+    if len(pos) > k:
+        # O(nnz) cut to the k-th weight; every tie at the boundary stays a candidate
+        kth = -np.partition(-wp, k - 1)[k - 1]
+        keep = wp >= kth
+        pos, wp = pos[keep], wp[keep]
+    return pos[np.argsort(-wp, kind="stable")[:k]]
+
+def _hash_index(tok, n_features):
+    """Column HashingVectorizer(alternate_sign=False) assigns to `tok`."""
+    h = murmurhash3_32(tok, seed=0)
+    if h == -2**31:  # abs() overflows in sklearn's C code; mirror its special case
+        return (2**31 - 1 - (n_features - 1)) % n_features
+    return abs(h) % n_features
+
+def _hashed_names(text, idx):
+    """Reverse-map hashed feature indices to the tokens of `text` that produced them."""
+    wanted = set(int(i) for i in idx)
+    names = {}
+    for tok in VEC.build_analyzer()(text):
+        i = _hash_index(tok, VEC.n_features)
+        if i in wanted and i not in names:
+            names[i] = tok
+            if len(names) == len(wanted):
+                break
+    return [names[i] for i in idx if i in names]
 
-    return {"risk_score": risk_score, "top_tokens": top_tokens}
+def _idx_names(idx, text):
+    if FEATS is not None:
+        return [str(FEATS[i]) for i in idx]
+    return _hashed_names(text, idx) if len(idx) else []
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _top_k_per_row(indptr, indices, weights, out_idx):
+        """Insertion-sort the positive weights of each CSR row into out_idx (-1 = empty slot)."""
+        k = out_idx.shape[1]
+        for r in prange(len(indptr) - 1):
+            best = np.full(k, -1, np.int64)
+            bestw = np.zeros(k)
+            for j in range(indptr[r], indptr[r + 1]):
+                i = indices[j]
+                w = weights[i]
+                if w > bestw[k - 1]:
+                    p = k - 1
+                    while p > 0 and w > bestw[p - 1]:
+                        bestw[p] = bestw[p - 1]
+                        best[p] = best[p - 1]
+                        p -= 1
+                    bestw[p] = w
+                    best[p] = i
+            out_idx[r] = best
+
+def _batch_top_indices(X, k=5):
+    """Top-k feature indices per row of X, via the Numba kernel when available."""
+    if njit is None:
+        return [_top_indices(X, r, WEIGHTS, k) for r in range(X.shape[0])]
+    out = np.full((X.shape[0], k), -1, np.int64)
+    _top_k_per_row(X.indptr, X.indices, np.asarray(WEIGHTS, dtype=np.float64), out)
+    return [row[row >= 0] for row in out]
+
+def _predict_proba(X):
+    """P(risky) per row; uses the int8-quantized linear scorer when it was saved."""
+    if QUANT is None:
+        return CLF.predict_proba(X)[:,1]
+    coef_q, scale, intercept = QUANT
+    z = (X @ coef_q) * scale + intercept
+    return 1.0 / (1.0 + np.exp(-z))
+
+def predict_email_risk_batch(items, explain=True):
+    """Score many emails at once; items are dicts with the predict_email_risk kwargs."""
+    _ensure_loaded()
+    results = []
+    for start in range(0, len(items), BATCH_SIZE):
+        texts = [_combine(**d) for d in items[start:start+BATCH_SIZE]]
+        X = VEC.transform(texts).tocsr()
+        probas = _predict_proba(X)
+        try:
+            tops = _batch_top_indices(X) if explain else None
+        except Exception:
+            tops = None
+        for r, proba in enumerate(probas):
+            # quick explain: top positive-weight tokens present
+            top_tokens = []
+            if tops is not None:
+                try:
+                    top_tokens = _idx_names(tops[r], texts[r])
+                except Exception:
+                    pass
+            results.append({"risk_score": int(round(float(proba)*100)), "top_tokens": top_tokens})
+    return results
+
+def predict_email_risk(subject, body, from_domain, reply_domain, attachment_types, amount):
+    return predict_email_risk_batch([dict(
+        subject=subject, body=body, from_domain=from_domain, reply_domain=reply_domain,
+        attachment_types=attachment_types, amount=amount
+    )])[0]
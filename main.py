@@ -1,19 +1,25 @@
 # --- Standard imports ---
-import os
 import re
 import imaplib
+import queue
+import threading
 from imaplib import IMAP4_SSL
 import email
 from email.header import decode_header, make_header
 from email.policy import default
+from email.parser import BytesHeaderParser
 from email.utils import parseaddr
 from pathlib import Path
-from datetime import datetime
-from openpyxl import Workbook, load_workbook
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from openpyxl import load_workbook
 import getpass
 
+from xlsx_writer import InvoiceXlsxWriter
+
 # --- Optional ML import (kept; guarded by try/except when called) ---
-from ai_fraud_ml import predict_email_risk
+from ai_fraud_ml import predict_email_risk_batch
 
 # =========================
 # Helpers (ML + parsing)
@@ -23,20 +29,44 @@ def domain_from_header(header_value: str) -> str:
     name, email_addr = parseaddr(header_value or "")
     return email_addr.split("@")[1].lower() if email_addr and "@" in email_addr else ""
 
+# Common extensions get one bit each; EXT_NAMES is alphabetical so the output matches sorted()
+EXT_NAMES = ["csv", "docx", "html", "jpg", "pdf", "png", "txt", "xlsx", "zip"]
+EXT_BITS = {ext: i for i, ext in enumerate(EXT_NAMES)}
+
+@lru_cache(maxsize=1 << len(EXT_NAMES))
+def _ext_mask_str(mask: int) -> str:
+    return ",".join(EXT_NAMES[i] for i in range(len(EXT_NAMES)) if mask >> i & 1)
+
 def attachment_types_from_list(names):
     """Return comma-separated lowercase file extensions from attachment names."""
-    exts = []
+    mask, other = 0, set()
     for n in names or []:
-        _, ext = os.path.splitext((n or "").strip())
-        if ext:
-            exts.append(ext.lstrip(".").lower())
-    return ",".join(sorted(set(exts))) if exts else ""
+        n = (n or "").strip()
+        dot = n.rfind(".")
+        if dot <= 0 or dot == len(n) - 1:
+            continue
+        ext = n[dot + 1:].lower()
+        if "/" in ext:
+            continue
+        b = EXT_BITS.get(ext)
+        if b is not None:
+            mask |= 1 << b
+        else:
+            other.add(ext)
+    if other:
+        # Rare extensions: fall back to the general sorted join
+        return ",".join(sorted(other | {EXT_NAMES[i] for i in range(len(EXT_NAMES)) if mask >> i & 1}))
+    return _ext_mask_str(mask)
+
+_AMT_RE = re.compile(r'([0-9]+(?:\.[0-9]{2})?)')
+
+AMOUNT_SCAN_CHARS = 4096  # amounts/totals sit near the top; bounds the work on huge bodies
 
 def extract_amount_guess(text: str):
     """Very simple amount extractor: looks for a number like 123.45 in the email body."""
     if not text:
         return None
-    m = re.search(r'([0-9]+(?:\.[0-9]{2})?)', text)
+    m = _AMT_RE.search(text, 0, AMOUNT_SCAN_CHARS)
     if m:
         try:
             return float(m.group(1))
@@ -52,46 +82,52 @@ def decode_mime_header(raw_value):
     except Exception:
         return str(raw_value)
 
-def extract_text_body(msg):
-    if msg.is_multipart():
-        parts = []
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            disp = str(part.get("Content-Disposition", ""))
-            if ctype == "text/plain" and "attachment" not in disp.lower():
-                try:
-                    parts.append(part.get_content())
-                except Exception:
-                    payload = part.get_payload(decode=True) or b""
-                    parts.append(payload.decode(errors="ignore"))
-        return "\n".join(parts).strip()
+def _part_text(part):
+    try:
+        return part.get_content()
+    except Exception:
+        return (part.get_payload(decode=True) or b"").decode(errors="ignore")
+
+def _attachment_info(part, save=False, save_dir=Path("attachments")):
+    raw_name = part.get_filename()
+    fname = decode_mime_header(raw_name) or "unnamed"
+    if save:
+        data = part.get_payload(decode=True)
+        size = len(data) if data else 0
     else:
-        if msg.get_content_type() == "text/plain":
-            try:
-                return msg.get_content()
-            except Exception:
-                return (msg.get_payload(decode=True) or b"").decode(errors="ignore")
-        return ""
+        # Size only; skip decoding (base64 is ~4/3 of the decoded length)
+        data = None
+        raw = part.get_payload(decode=False) or ""
+        raw = raw if isinstance(raw, str) else ""
+        is_b64 = part.get("Content-Transfer-Encoding", "").lower() == "base64"
+        size = (len(raw) * 3) // 4 if is_b64 else len(raw)
+    ctype = part.get_content_type()
+    is_pdf = (ctype == "application/pdf") or fname.lower().endswith(".pdf")
+    if save and data:
+        try:
+            save_dir.mkdir(exist_ok=True)
+            (save_dir / fname).write_bytes(data)
+        except Exception as e:
+            print("Couldn't save attachment", fname, e)
+    return (fname, size, is_pdf, data)
 
-def list_attachments(msg, save=False, save_dir=Path("attachments")):
-    out = []
+def _parse_message(msg, save=False, save_dir=Path("attachments")):
+    """Single msg.walk() -> (plain-text body, [(fname, size, is_pdf, data), ...]).
+
+    Text/plain parts without an attachment disposition make up the body; any part
+    whose Content-Disposition mentions "attachment" is listed, at any depth.
+    """
+    multipart = msg.is_multipart()
+    texts, attachments = [], []
     for part in msg.walk():
-        disp = str(part.get("Content-Disposition", ""))
-        if "attachment" in disp.lower():
-            raw_name = part.get_filename()
-            fname = decode_mime_header(raw_name) or "unnamed"
-            data = part.get_payload(decode=True)
-            size = len(data) if data else 0
-            ctype = part.get_content_type()
-            is_pdf = (ctype == "application/pdf") or fname.lower().endswith(".pdf")
-            if save and data:
-                try:
-                    save_dir.mkdir(exist_ok=True)
-                    (save_dir / fname).write_bytes(data)
-                except Exception as e:
-                    print("Couldn't save attachment", fname, e)
-            out.append((fname, size, is_pdf, data if save else None))
-    return out
+        is_att = "attachment" in str(part.get("Content-Disposition", "")).lower()
+        if is_att:
+            attachments.append(_attachment_info(part, save, save_dir))
+        if part.get_content_type() == "text/plain" and (not is_att or not multipart):
+            texts.append(_part_text(part))
+    if not multipart:
+        return (texts[0] if texts else ""), attachments
+    return "\n".join(texts).strip(), attachments
 
 # =========================
 # Simple invoice heuristic
@@ -100,40 +136,60 @@ KEYWORDS = {"invoice", "payment", "receipt", "bill", "statement", "due", "amount
 INVOICE_RE = re.compile(r"(?i)(invoice\s*#?\s*\d{3,}|inv[-\s]?\d{3,}|#\d{3,})")
 
 def looks_like_invoice(subject, body, attachments):
-    text = f"{subject}\n{body}".lower()
-    kw_hit = "invoice" in text  # minimal heuristic
-    is_invoice = kw_hit
-    reason = "keyword" if kw_hit else "no strong signal"
-    return is_invoice, reason
+    # minimal heuristic; the short subject is checked first so the body is only lowercased on a miss
+    if "invoice" in (subject or "").lower():
+        return True, "keyword-subject"
+    if "invoice" in (body or "").lower():
+        return True, "keyword-body"
+    return False, "no strong signal"
 
 # =========================
 # Excel helpers
 # =========================
+HEADER = [
+    "SavedAt","From","Subject","Date","HasPDF","AttachmentNames","Reason","MessageID",
+    "FromDomain","ReplyDomain","AttachmentTypes","AmountGuess",
+    "ML Risk Score","ML Top Tokens"
+]
+
 def ensure_workbook(path: Path):
+    """Open a streaming writer for this run; rows from an existing file are carried over once."""
+    ws = InvoiceXlsxWriter(path, sheet_name="Invoices")
     if path.exists():
-        return load_workbook(path)
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Invoices"
-    ws.append([
-        "SavedAt","From","Subject","Date","HasPDF","AttachmentNames","Reason","MessageID",
-        "FromDomain","ReplyDomain","AttachmentTypes","AmountGuess",
-        "ML Risk Score","ML Top Tokens"
-    ])
-    wb.save(path)
-    return wb
+        old = load_workbook(path, read_only=True)
+        try:
+            for row in old["Invoices"].iter_rows(values_only=True):
+                ws.append(row)
+        finally:
+            old.close()
+    else:
+        ws.append(HEADER)
+    return ws
 
-def append_invoice_row(path: Path, *, from_, subject, date_str, has_pdf, attach_names, reason, message_id,
+def append_invoice_row(ws, *, from_, subject, date_str, has_pdf, attach_names, reason, message_id,
                        from_domain="", reply_domain="", attachment_types="", amount_guess="",
                        ml_risk_score="", ml_top_tokens=""):
-    wb = ensure_workbook(path); ws = wb["Invoices"]
     saved_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     ws.append([
         saved_at, from_, subject, date_str, has_pdf, ", ".join(attach_names), reason, message_id,
         from_domain, reply_domain, attachment_types, amount_guess,
         ml_risk_score, ml_top_tokens
     ])
-    wb.save(path)
+
+# =========================
+# Dedup of processed emails
+# =========================
+def load_seen_ids(path: Path):
+    """Message-IDs written on earlier runs, plus when the file was last updated (None if new)."""
+    if not path.exists():
+        return set(), None
+    seen = set(path.read_text(encoding="utf-8").splitlines())
+    return seen, datetime.fromtimestamp(path.stat().st_mtime)
+
+def record_seen_ids(path: Path, message_ids):
+    with open(path, "a", encoding="utf-8", buffering=1 << 20) as f:
+        for mid in message_ids:
+            f.write(mid + "\n")
 
 # =========================
 # IMAP keep-alive
@@ -147,6 +203,44 @@ def maybe_keepalive(imap, i, every=50):
             # Optionally implement reconnect here
             pass
 
+FETCH_BATCH = 50
+_UID_RE = re.compile(rb"UID (\d+)")
+
+_HDR_PARSER = BytesHeaderParser(policy=default)  # stops at the blank line; never tokenizes a body
+HEADER_QUERY = "(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE MESSAGE-ID REPLY-TO)])"
+FULL_QUERY = "(BODY.PEEK[])"  # PEEK never flips \\Seen
+
+def fetch_uids(imap, uids, query=FULL_QUERY, batch_size=FETCH_BATCH):
+    """Yield (uid, raw_bytes) in the given order, fetching batch_size messages per UID FETCH."""
+    for b, start in enumerate(range(0, len(uids), batch_size), 1):
+        batch = uids[start:start + batch_size]
+        maybe_keepalive(imap, b, every=1)
+
+        status, msg_data = imap.uid("FETCH", b",".join(batch), query)
+        if status != "OK":
+            print("Fetch failed for", b",".join(batch))
+            continue
+
+        # Responses come as (b'N (UID 123 BODY[] {size}', raw_bytes) tuples separated by b')';
+        # some servers echo the UID after the literal instead, i.e. in the closing piece.
+        fetched, last = {}, None
+        for item in msg_data:
+            if isinstance(item, tuple):
+                m = _UID_RE.search(item[0])
+                last = None if m else item[1]
+                if m:
+                    fetched[m.group(1)] = item[1]
+            elif item and last is not None:
+                m = _UID_RE.search(item)
+                if m:
+                    fetched[m.group(1)] = last
+                last = None
+        for uid in batch:
+            if uid in fetched:
+                yield uid, fetched[uid]
+            else:
+                print("Fetch failed for", uid)
+
 # =========================
 # Settings / Inputs
 # =========================
@@ -159,6 +253,60 @@ MAILBOX = "INBOX"
 EXCEL_PATH = Path("invoices.xlsx")
 SAVE_ATTACHMENTS = False
 ATTACH_DIR = Path("attachments")
+# Reject on Subject from a header-only fetch before downloading full messages
+# (emails that mention "invoice" only in the body are skipped when enabled)
+HEADER_PREFILTER = True
+# Message-IDs already saved to EXCEL_PATH; delete this file to re-process everything
+PROCESSED_IDS_PATH = Path("processed_ids.txt")
+
+# =========================
+# Fetch/parse pipeline
+# =========================
+FETCH_QUEUE_SIZE = 64
+PARSE_WORKERS = 4
+_DONE = object()
+
+def _produce(imap, uids, q, errors):
+    """Producer thread: push (uid, raw_bytes) from batched fetches, then a _DONE sentinel."""
+    try:
+        for item in fetch_uids(imap, uids):
+            q.put(item)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        q.put(_DONE)
+
+def parse_candidate(raw_bytes):
+    """Parse one raw message -> (subject, from_, candidate); candidate is None for non-invoices."""
+    msg = email.message_from_bytes(raw_bytes, policy=default)
+
+    subject = decode_mime_header(msg.get("Subject"))
+    from_   = decode_mime_header(msg.get("From"))
+    date_h  = decode_mime_header(msg.get("Date"))
+    body, attachments = _parse_message(msg, save=SAVE_ATTACHMENTS, save_dir=ATTACH_DIR)
+
+    is_inv, reason = looks_like_invoice(subject, body, attachments)
+    if not is_inv:
+        return subject, from_, None
+
+    has_pdf = any(is_pdf for _, _, is_pdf, _ in attachments)
+    attach_names = [a[0] for a in attachments] if attachments else []
+    message_id = decode_mime_header(msg.get("Message-ID"))
+
+    # Build ML inputs
+    amount = extract_amount_guess(subject)
+    if amount is None:
+        amount = extract_amount_guess(body)
+    return subject, from_, dict(
+        subject=subject,
+        body=body,
+        from_domain=domain_from_header(from_),
+        reply_domain=domain_from_header(decode_mime_header(msg.get("Reply-To"))),
+        attachment_types=attachment_types_from_list(attach_names),
+        amount=amount,
+        row_meta=dict(from_=from_, date_str=date_h, has_pdf=has_pdf,
+                      attach_names=attach_names, reason=reason, message_id=message_id),
+    )
 
 # =========================
 # Main
@@ -168,86 +316,93 @@ def process_all(limit: int = 200):
         imap.login(GMAIL_ADDRESS, APP_PASSWORD)
         imap.select(MAILBOX, readonly=True)
 
-        SEARCH_CRITERIA = 'ALL'
-        status, data = imap.search(None, SEARCH_CRITERIA)
+        seen, last_run = load_seen_ids(PROCESSED_IDS_PATH)
+
+        # Let the server narrow the mailbox down before anything is fetched
+        SEARCH_CRITERIA = '(OR SUBJECT "invoice" BODY "invoice")'
+        if last_run:
+            # SINCE is date-only; go back a day so timezone skew can't drop mail
+            since = (last_run - timedelta(days=1)).strftime("%d-%b-%Y")
+            SEARCH_CRITERIA = f"(SINCE {since} {SEARCH_CRITERIA})"
+        status, data = imap.uid("SEARCH", None, SEARCH_CRITERIA)
         if status != "OK":
             print("Search failed:", status)
             return
 
         msg_ids = data[0].split()
         print(f"Found {len(msg_ids)} messages matching {SEARCH_CRITERIA}.")
-        # Scan the most recent N
-        msg_ids = msg_ids[-min(limit, 200):]
-
-        count = 0
-        for i, msg_id in enumerate(reversed(msg_ids), 1):
-            maybe_keepalive(imap, i, every=50)
-
-            status, msg_data = imap.fetch(msg_id, "(RFC822)")
-            if status != "OK":
-                print("Fetch failed for", msg_id)
-                continue
-
-            raw_bytes = msg_data[0][1]
-            msg = email.message_from_bytes(raw_bytes, policy=default)
-
-            subject = decode_mime_header(msg.get("Subject"))
-            from_   = decode_mime_header(msg.get("From"))
-            date_h  = decode_mime_header(msg.get("Date"))
-            body = extract_text_body(msg)
-            attachments = list_attachments(msg, save=SAVE_ATTACHMENTS, save_dir=ATTACH_DIR)
-
-            is_inv, reason = looks_like_invoice(subject, body, attachments)
-
-            has_pdf = any(is_pdf for _, _, is_pdf, _ in attachments)
-            attach_names = [a[0] for a in attachments] if attachments else []
-            message_id = decode_mime_header(msg.get("Message-ID"))
-
-            print("DEBUG:", subject, "| From:", from_)
-
-            if is_inv:
-                # Build ML inputs
-                from_domain    = domain_from_header(from_)
-                reply_domain   = domain_from_header(decode_mime_header(msg.get("Reply-To")))
-                attachment_types = attachment_types_from_list(attach_names)
-                amount_value   = extract_amount_guess(f"{subject}\n{body}")
-
-                # Call ML safely (in case the module/return shape changes)
-                try:
-                    ml = predict_email_risk(
-                        subject=subject,
-                        body=body,
-                        from_domain=from_domain,
-                        reply_domain=reply_domain,
-                        attachment_types=attachment_types,
-                        amount=amount_value
-                    )
-                    ml_score  = ml.get("risk_score", "")
-                    ml_tokens = ", ".join(ml.get("top_tokens", []))
-                except Exception:
-                    ml_score, ml_tokens = "", ""
+        # Scan the most recent N, newest first
+        msg_ids = msg_ids[-min(limit, 200):][::-1]
+
+        # Header-only pass: drop already-processed emails (and, optionally, non-invoice subjects)
+        survivors = []
+        for msg_id, raw_hdr in fetch_uids(imap, msg_ids, HEADER_QUERY):
+            hdr = _HDR_PARSER.parsebytes(raw_hdr)
+            subject = decode_mime_header(hdr.get("Subject"))
+            if decode_mime_header(hdr.get("Message-ID")) in seen:
+                print(f"· Already saved: {subject!r}")
+            elif HEADER_PREFILTER and not looks_like_invoice(subject, "", [])[0]:
+                print(f"· Skipped: {subject!r}")
+            else:
+                survivors.append(msg_id)
+        msg_ids = survivors
+
+        # Pass 1: a producer thread fetches while the pool parses; results are kept newest-first
+        pending = []
+        q = queue.Queue(maxsize=FETCH_QUEUE_SIZE)
+        errors = []
+        producer = threading.Thread(target=_produce, args=(imap, msg_ids, q, errors), daemon=True)
+        producer.start()
+        with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+            futures = []
+            while (item := q.get()) is not _DONE:
+                futures.append(pool.submit(parse_candidate, item[1]))
+            producer.join()
+            if errors:
+                raise errors[0]
+
+            for fut in futures:
+                subject, from_, candidate = fut.result()
+                print("DEBUG:", subject, "| From:", from_)
+                if candidate:
+                    pending.append(candidate)
+                else:
+                    print(f"· Skipped: {subject!r}")
+
+        # Pass 2: score all candidates in one batched ML call (safe in case the module/return shape changes)
+        try:
+            mls = predict_email_risk_batch([
+                {k: v for k, v in d.items() if k != "row_meta"} for d in pending
+            ])
+        except Exception:
+            mls = [{} for _ in pending]
+
+        # Pass 3: stream all rows into the workbook
+        ws = ensure_workbook(EXCEL_PATH)
+        try:
+            for d, ml in zip(pending, mls):
+                ml_score  = ml.get("risk_score", "")
+                ml_tokens = ", ".join(ml.get("top_tokens", []))
+                amount_value = d["amount"]
 
                 append_invoice_row(
-                    EXCEL_PATH,
-                    from_=from_,
-                    subject=subject,
-                    date_str=date_h,
-                    has_pdf=has_pdf,
-                    attach_names=attach_names,
-                    reason=reason,
-                    message_id=message_id,
-                    from_domain=from_domain,
-                    reply_domain=reply_domain,
-                    attachment_types=attachment_types,
+                    ws,
+                    subject=d["subject"],
+                    from_domain=d["from_domain"],
+                    reply_domain=d["reply_domain"],
+                    attachment_types=d["attachment_types"],
                     amount_guess=amount_value if amount_value is not None else "",
                     ml_risk_score=ml_score,
-                    ml_top_tokens=ml_tokens
+                    ml_top_tokens=ml_tokens,
+                    **d["row_meta"]
                 )
 
-                print(f"✔ Saved invoice: {subject!r} | reason: {reason} | ML Risk={ml_score}")
-                count += 1
-            else:
-                print(f"· Skipped: {subject!r}")
+                print(f"✔ Saved invoice: {d['subject']!r} | reason: {d['row_meta']['reason']} | ML Risk={ml_score}")
+        finally:
+            ws.close()
+        record_seen_ids(PROCESSED_IDS_PATH, [d["row_meta"]["message_id"] for d in pending
+                                            if d["row_meta"]["message_id"]])
+        count = len(pending)
 
         # ONE safe logout (with `with` it auto-closes anyway)
         try:
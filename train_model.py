@@ -1,7 +1,7 @@
 # train_model.py
 import pandas as pd, numpy as np, re
 from sklearn.linear_model import LogisticRegression
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report
 from joblib import dump
@@ -45,7 +45,9 @@ def main():
         stratify=y if len(np.unique(y))>1 else None
     )
 
-    vec = TfidfVectorizer(max_features=20000, ngram_range=(1,2), lowercase=True)
+    # Stateless: no vocabulary to build or look up at inference time
+    vec = HashingVectorizer(n_features=2**18, ngram_range=(1,2), lowercase=True,
+                            alternate_sign=False, norm="l2")
     Xtrv = vec.fit_transform(Xtr)
     Xvav = vec.transform(Xva)
 
@@ -57,7 +59,17 @@ def main():
 
     dump(clf, "fraud_model.joblib")
     dump(vec, "vectorizer.joblib")
-    print("\nSaved fraud_model.joblib and vectorizer.joblib")
+    # Plain arrays that ai_fraud_ml memory-maps instead of unpickling the classifier
+    np.save("coef.npy", clf.coef_)
+    np.save("intercept.npy", clf.intercept_)
+
+    # int8 copy of the linear scorer for fast inference (see ai_fraud_ml._predict_proba)
+    coef = clf.coef_[0]
+    scale = float(np.max(np.abs(coef))) / 127 or 1.0
+    dump({"coef_q": np.round(coef / scale).astype(np.int8),
+          "scale": scale,
+          "intercept": float(clf.intercept_[0])}, "fraud_model_q.joblib")
+    print("\nSaved fraud_model.joblib, vectorizer.joblib, coef.npy, intercept.npy and fraud_model_q.joblib")
 
 if __name__ == "__main__":
     main()
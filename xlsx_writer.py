@@ -0,0 +1,113 @@
+# xlsx_writer.py
+import io
+import os
+import re
+import zipfile
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+_DOC_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+CONTENT_TYPES = (
+    _HEAD +
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+ROOT_RELS = (
+    _HEAD +
+    f'<Relationships xmlns="{_REL_NS}">'
+    f'<Relationship Id="rId1" Type="{_DOC_REL}/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+WORKBOOK_RELS = (
+    _HEAD +
+    f'<Relationships xmlns="{_REL_NS}">'
+    f'<Relationship Id="rId1" Type="{_DOC_REL}/worksheet" Target="worksheets/sheet1.xml"/>'
+    f'<Relationship Id="rId2" Type="{_DOC_REL}/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+STYLES = (
+    _HEAD +
+    f'<styleSheet xmlns="{_NS}">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+# Control characters XML 1.0 does not allow (emails do contain them)
+_ILLEGAL_XML = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def _cell(v):
+    if v is None or v == "":
+        return "<c/>"
+    if isinstance(v, bool):
+        return f'<c t="b"><v>{int(v)}</v></c>'
+    if isinstance(v, (int, float)):
+        return f"<c><v>{v!r}</v></c>"
+    text = escape(_ILLEGAL_XML.sub("", str(v)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+class InvoiceXlsxWriter:
+    """Append-only single-sheet .xlsx writer that streams rows straight into the zip.
+
+    The file is written next to `path` and moved into place on close(), so an
+    existing workbook can still be read while the new one is being written.
+    """
+
+    def __init__(self, path: Path, sheet_name="Invoices"):
+        self.path = Path(path)
+        self._tmp = self.path.with_name(self.path.name + ".tmp")
+        # Large buffer + fastest deflate: zipfile otherwise issues many small writes
+        self._buf = io.BufferedWriter(open(self._tmp, "wb"), buffer_size=1 << 20)
+        self._zf = zipfile.ZipFile(self._buf, "w", zipfile.ZIP_DEFLATED, compresslevel=1)
+        self._zf.writestr("[Content_Types].xml", CONTENT_TYPES)
+        self._zf.writestr("_rels/.rels", ROOT_RELS)
+        self._zf.writestr("xl/workbook.xml", (
+            _HEAD +
+            f'<workbook xmlns="{_NS}" xmlns:r="{_DOC_REL}"><sheets>'
+            f'<sheet name="{escape(sheet_name)}" sheetId="1" r:id="rId1"/>'
+            '</sheets></workbook>'
+        ))
+        self._zf.writestr("xl/_rels/workbook.xml.rels", WORKBOOK_RELS)
+        self._zf.writestr("xl/styles.xml", STYLES)
+        self._sheet = self._zf.open("xl/worksheets/sheet1.xml", "w")
+        self._sheet.write(f'{_HEAD}<worksheet xmlns="{_NS}"><sheetData>'.encode())
+        self._rows = 0
+
+    def append(self, values):
+        self._rows += 1
+        cells = "".join(_cell(v) for v in values)
+        self._sheet.write(f'<row r="{self._rows}">{cells}</row>'.encode())
+
+    def close(self):
+        if self._zf is None:
+            return
+        self._sheet.write(b"</sheetData></worksheet>")
+        self._sheet.close()
+        self._zf.close()
+        self._buf.close()
+        self._zf = None
+        os.replace(self._tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()